@@ -3,13 +3,27 @@ DIBOL Table Definition Parser
 Parses DIBOL (.DEF) files and outputs structured metadata suitable for Apache Pulsar
 """
 
+import mmap
+import os
 import re
 import json
-from typing import List, Dict, Any, Optional
-from dataclasses import dataclass, asdict
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from dataclasses import dataclass, field
 
+import orjson
 
-@dataclass
+# Compiled once at import so the per-line parsing loop skips the re module's
+# pattern-cache lookup on every call.
+_DEVNO_RE = re.compile(r'DEVNO=(\d+)')
+# Captures field name and type spec in one shot: <name> ,<type><length> with
+# an optional count prefix (A254, D1, 254D1); the name may be empty (filler)
+_FIELD_LINE_RE = re.compile(r'\s*([^,;\s]*)\s*,\s*(\d*)([ADX])(\d+)')
+# One multi-alternative pattern walks the whole DEF content in a single C-level
+# pass: RECORD headers, indented field definitions and optional ';' comments.
+_LINE_RE = re.compile(r'(?m)^(?:(?P<rec>RECORD[^\n;]*)|[ \t]+(?P<fld>[^\n;]+))(?:;(?P<cmt>[^\n]*))?$')
+
+
+@dataclass(slots=True)
 class DibolField:
     """Represents a single field in a DIBOL record"""
     field_name: str
@@ -19,40 +33,47 @@ class DibolField:
     start_pos: int = 0
     end_pos: int = 0
     comment: str = ""
-    
+    _cached_dict: Optional[Dict[str, Any]] = field(default=None, repr=False, compare=False)
+
     def to_dict(self) -> Dict[str, Any]:
-        """Convert to dictionary for JSON serialization"""
-        return {
-            'field_name': self.field_name,
-            'data_type': self.data_type,
-            'length': self.length,
-            'decimals': self.decimals,
-            'start_pos': self.start_pos,
-            'end_pos': self.end_pos,
-            'comment': self.comment
-        }
+        """Convert to dictionary for JSON serialization (built once, then cached)"""
+        if self._cached_dict is None:
+            self._cached_dict = {
+                'field_name': self.field_name,
+                'data_type': self.data_type,
+                'length': self.length,
+                'decimals': self.decimals,
+                'start_pos': self.start_pos,
+                'end_pos': self.end_pos,
+                'comment': self.comment
+            }
+        return self._cached_dict
 
 
-@dataclass
+@dataclass(slots=True)
 class DibolRecord:
     """Represents a DIBOL record structure"""
     record_name: str
     is_overlay: bool = False
-    fields: List[DibolField] = None
+    # frozen to a tuple once parsing is done
+    fields: Tuple[DibolField, ...] = None
     device_no: int = None
-    
+    _cached_dict: Optional[Dict[str, Any]] = field(default=None, repr=False, compare=False)
+
     def __post_init__(self):
         if self.fields is None:
-            self.fields = []
-    
+            self.fields = ()
+
     def to_dict(self) -> Dict[str, Any]:
-        """Convert to dictionary for JSON serialization"""
-        return {
-            'record_name': self.record_name,
-            'is_overlay': self.is_overlay,
-            'device_no': self.device_no,
-            'fields': [f.to_dict() for f in self.fields]
-        }
+        """Convert to dictionary for JSON serialization (built once, then cached)"""
+        if self._cached_dict is None:
+            self._cached_dict = {
+                'record_name': self.record_name,
+                'is_overlay': self.is_overlay,
+                'device_no': self.device_no,
+                'fields': [f.to_dict() for f in self.fields]
+            }
+        return self._cached_dict
 
 
 class DibolParser:
@@ -61,7 +82,18 @@ class DibolParser:
     def __init__(self):
         self.records: List[DibolRecord] = []
         self.current_record: DibolRecord = None
-        
+        # Fields are collected here and handed to the record in one
+        # assignment at the record boundary
+        self._fields_accum: List[DibolField] = []
+        self._finalized = False
+
+    def _finalize(self):
+        """Append the trailing record once; O(1) flag instead of a list scan"""
+        if not self._finalized and self.current_record and self._fields_accum:
+            self.current_record.fields = tuple(self._fields_accum)
+            self.records.append(self.current_record)
+            self._finalized = True
+
     def parse_file(self, filepath: str) -> List[DibolRecord]:
         """Parse a DIBOL definition file"""
         with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
@@ -71,25 +103,21 @@ class DibolParser:
     
     def parse_content(self, content: str) -> List[DibolRecord]:
         """Parse DIBOL definition content"""
-        lines = content.split('\n')
-        
-        for line in lines:
-            # Skip empty lines and pure comment lines
-            if not line.strip() or line.strip().startswith(';'):
-                continue
-            
-            # Remove inline comments but keep position info
-            parts = line.split(';', 1)
-            code_part = parts[0]
-            comment_part = parts[1].strip() if len(parts) > 1 else ""
-            
-            # Check for RECORD definition
-            if code_part.strip().startswith('RECORD'):
-                self._parse_record_line(code_part, comment_part)
-            # Check for field definition (indented with tab or spaces)
-            elif code_part.startswith('\t') or (code_part.startswith(' ') and not code_part.strip().startswith('RECORD')):
-                self._parse_field_line(code_part, comment_part)
-        
+        # Comment-only and empty lines match neither alternative, so the
+        # scanner skips them without any per-line Python string work.
+        for m in _LINE_RE.finditer(content):
+            comment = (m['cmt'] or '').strip()
+            rec = m['rec']
+            if rec is not None:
+                self._parse_record_line(rec, comment)
+            else:
+                fld = m['fld']
+                # An indented RECORD line still starts a new record
+                if fld.lstrip().startswith('RECORD'):
+                    self._parse_record_line(fld, comment)
+                else:
+                    self._parse_field_line(fld, comment)
+
         return self.records
     
     def _parse_record_line(self, line: str, comment: str):
@@ -104,14 +132,16 @@ class DibolParser:
             # Extract device number from comment if present
             device_no = None
             if 'DEVNO=' in comment:
-                match = re.search(r'DEVNO=(\d+)', comment)
+                match = _DEVNO_RE.search(comment)
                 if match:
                     device_no = int(match.group(1))
             
-            # If we have a current record, save it
-            if self.current_record and self.current_record.fields:
+            # If we have a current record, save it (fields frozen for good)
+            if self.current_record and self._fields_accum:
+                self.current_record.fields = tuple(self._fields_accum)
                 self.records.append(self.current_record)
-            
+            self._fields_accum = []
+
             # Start new record
             self.current_record = DibolRecord(
                 record_name=record_name,
@@ -128,29 +158,15 @@ class DibolParser:
         if not self.current_record:
             return
         
-        # Clean up the line
-        line = line.strip()
-        if not line:
-            return
-        
         # Pattern: <fieldname> ,<type><length> or just ,<type><length> for filler
         # Examples: INVA ,A254  or  IVHDEL ,D1  or  ,A6
-        parts = line.split(',', 1)
-        if len(parts) != 2:
-            return
-        
-        field_name = parts[0].strip()
-        type_spec = parts[1].strip()
-        
-        # Parse type and length (e.g., "A254", "D1", "254D1")
-        # Handle both formats: A254 and 254D1
-        type_match = re.match(r'(\d*)([ADX])(\d+)', type_spec)
+        # One combined regex replaces the strip/split/strip/strip sequence
+        # plus the separate type-spec match
+        type_match = _FIELD_LINE_RE.match(line)
         if not type_match:
             return
-        
-        prefix_digits = type_match.group(1)
-        data_type = type_match.group(2)
-        length_spec = type_match.group(3)
+
+        field_name, prefix_digits, data_type, length_spec = type_match.groups()
         
         # For formats like "254D1", the first number is count, second is decimals
         if prefix_digits:
@@ -161,16 +177,19 @@ class DibolParser:
             decimals = 0
         
         # Extract position information from comment
-        start_pos, end_pos = self._extract_positions(comment)
-        
-        # Clean up comment - remove position info
-        clean_comment = re.sub(r'\d{3}-\d{3}', '', comment).strip()
+        start_pos, end_pos, pos_idx = self._extract_positions(comment)
+
+        # Clean up comment - slice out the 7-char position window
+        if pos_idx >= 0:
+            clean_comment = (comment[:pos_idx] + comment[pos_idx + 7:]).strip()
+        else:
+            clean_comment = comment.strip()
         
         # Handle filler fields (unnamed)
         if not field_name:
             field_name = f"FILLER_{start_pos}_{end_pos}" if start_pos else "FILLER"
         
-        field = DibolField(
+        new_field = DibolField(
             field_name=field_name,
             data_type=data_type,
             length=length,
@@ -180,50 +199,49 @@ class DibolParser:
             comment=clean_comment
         )
         
-        self.current_record.fields.append(field)
+        self._fields_accum.append(new_field)
     
     def _extract_positions(self, comment: str) -> tuple:
-        """Extract start and end positions from comment"""
+        """Extract start and end positions (and their offset) from comment
+
+        The NNN-NNN shape is fixed, so a direct character scan beats firing
+        up the regex engine and allocating a match object per field.
+        Returns (start, end, index) with index -1 when no positions found.
+        """
         # Pattern: XXX-XXX (e.g., 001-001, 002-007)
-        match = re.search(r'(\d{3})-(\d{3})', comment)
-        if match:
-            return int(match.group(1)), int(match.group(2))
-        return 0, 0
+        n = len(comment) - 7
+        i = 0
+        while i <= n:
+            if comment[i + 3] == '-' and comment[i:i + 3].isdigit() and comment[i + 4:i + 7].isdigit():
+                return int(comment[i:i + 3]), int(comment[i + 4:i + 7]), i
+            i += 1
+        return 0, 0, -1
     
     def to_json(self, indent: int = 2) -> str:
         """Convert parsed records to JSON format"""
-        # Add the last record if exists
-        if self.current_record and self.current_record.fields:
-            if self.current_record not in self.records:
-                self.records.append(self.current_record)
-        
+        self._finalize()
+
         data = {
             'records': [record.to_dict() for record in self.records]
         }
-        return json.dumps(data, indent=indent)
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()
     
     def to_compact_json(self) -> str:
         """Convert to compact JSON suitable for Pulsar payload"""
-        # Add the last record if exists
-        if self.current_record and self.current_record.fields:
-            if self.current_record not in self.records:
-                self.records.append(self.current_record)
-        
+        self._finalize()
+
         data = {
             'records': [record.to_dict() for record in self.records]
         }
-        return json.dumps(data, separators=(',', ':'))
+        return orjson.dumps(data).decode()
     
     def to_pulsar_messages(self) -> List[Dict[str, Any]]:
         """
         Convert to individual Pulsar messages (one per record)
         Each message contains metadata for one DIBOL record
         """
-        # Add the last record if exists
-        if self.current_record and self.current_record.fields:
-            if self.current_record not in self.records:
-                self.records.append(self.current_record)
-        
+        self._finalize()
+
         messages = []
         for record in self.records:
             message = {
@@ -232,100 +250,137 @@ class DibolParser:
                 'is_overlay': record.is_overlay,
                 'device_no': record.device_no,
                 'field_count': len(record.fields),
-                'fields': [f.to_dict() for f in record.fields],
-                'total_length': max([f.end_pos for f in record.fields]) if record.fields else 0
+                # reuse the record's cached field dicts; fields are sequential
+                # so the last end_pos is the record length - no max() pass
+                'fields': record.to_dict()['fields'],
+                'total_length': record.fields[-1].end_pos if record.fields else 0
             }
             messages.append(message)
         
         return messages
 
 
+# Record code at byte 7 maps straight to the schema record name
+_HDR_PREFIX = b'        '
+_TYPE_TABLE = {b'0': 'INVHDR,X', b'1': 'INVPOR,X', b'2': 'INVDTL'}
+
+
+def _make_alpha_fn(start: int, end: int, name: str):
+    """Build the extractor closure for one alpha field"""
+    def fn(line: bytes, record: dict):
+        value = line[start:end].strip() if end <= len(line) else b''
+        record[name] = value.decode('latin-1', 'ignore')
+    return fn
+
+
+def _make_numeric_fn(start: int, end: int, divisor: int, name: str):
+    """Build the extractor closure for one numeric field"""
+    def fn(line: bytes, record: dict):
+        value = line[start:end].strip() if end <= len(line) else b''
+        # All-digits (the typical case) and empty values skip the
+        # try/except machinery entirely
+        if not value:
+            int_val = 0
+        elif value.isdigit():
+            int_val = int(value)
+        else:
+            # Fallback covers signed values and garbage
+            try:
+                int_val = int(value)
+            except ValueError:
+                int_val = 0
+        record[name] = int_val / divisor if divisor > 1 else int_val
+    return fn
+
+
 class DibolDataParser:
     """Parse DIBOL data files using schema definitions"""
 
     def __init__(self, schema: list):
         """Initialize with DIBOL schema file (.def)"""
         self.schemas = {r.record_name: r for r in schema}
+        # Compile one extractor closure per field up front: the per-line loop
+        # is then a plain fn(line, record) call with positions, divisor and
+        # lowered name baked in - no type branch, no attribute loads
+        self._fns = {}
+        for name, r in self.schemas.items():
+            fns = []
+            for f in r.fields:
+                if f.data_type == 'A':
+                    fns.append(_make_alpha_fn(f.start_pos - 1, f.end_pos,
+                                              f.field_name.lower()))
+                elif f.data_type == 'D':
+                    fns.append(_make_numeric_fn(f.start_pos - 1, f.end_pos,
+                                                10 ** f.decimals if f.decimals > 0 else 1,
+                                                f.field_name.lower()))
+            self._fns[name] = fns
 
     @staticmethod
-    def identify_record_type(line: str) -> Optional[str]:
-        """Identify record type from data line"""
+    def identify_record_type(line: bytes) -> Optional[str]:
+        """Identify record type from a raw data line"""
         if len(line) < 8:
             return None
 
-        # Header line
-        if line.startswith('        '):
+        # Header line: single 8-byte equality instead of startswith
+        if line[:8] == _HDR_PREFIX:
             return 'FILE_HEADER'
 
+        # Record code at position 8 (0-indexed = 7), one dict probe
+        record_type = _TYPE_TABLE.get(line[7:8])
+        if record_type:
+            return record_type
+
         # End marker
-        if line.strip().startswith(']'):
+        if line.strip().startswith(b']'):
             return 'END_MARKER'
 
-        # Record code at position 8 (0-indexed = 7)
-        if len(line) >= 8:
-            record_code = line[7:8]
-            if record_code == '0':
-                return 'INVHDR,X'  # Header
-            elif record_code == '1':
-                return 'INVPOR,X'  # PO/Instructions
-            elif record_code == '2':
-                return 'INVDTL'  # Detail
-
         return None
 
-    def parse_line(self, line: str, record_name: str) -> Optional[Dict[str, Any]]:
-        """Parse a data line according to record schema"""
-        if record_name not in self.schemas:
+    def parse_line(self, line: bytes, record_name: str) -> Optional[Dict[str, Any]]:
+        """Parse a raw data line according to record schema"""
+        fns = self._fns.get(record_name)
+        if fns is None:
             return None
 
-        schema = self.schemas[record_name]
         record = {}
-
-        for field in schema.fields:
-            # Use start_pos from DibolField (already 1-indexed in the schema)
-            start = field.start_pos - 1  # Convert to 0-indexed
-            end = field.end_pos  # end_pos is already inclusive
-
-            if end > len(line):
-                value = ''
-            else:
-                value = line[start:end].strip()
-
-            # Type conversion
-            if field.data_type == 'A':
-                record[field.field_name.lower()] = value
-            elif field.data_type == 'D':
-                try:
-                    int_val = int(value) if value else 0
-                    if field.decimals > 0:
-                        record[field.field_name.lower()] = int_val / (10 ** field.decimals)
-                    else:
-                        record[field.field_name.lower()] = int_val
-                except ValueError:
-                    record[field.field_name.lower()] = 0
-
+        for fn in fns:
+            fn(line, record)
         return record
 
-    def parse_file(self, data_file: str) -> Dict[str, List[Dict]]:
-        """Parse entire data file and return structured data"""
-        results = {
-            'headers': [],
-            'details': [],
-            'po_records': []
-        }
+    def iter_records(self, data_file: str) -> Iterator[Tuple[str, Dict]]:
+        """Stream ('header'|'detail'|'po', record) tuples from a data file.
 
+        Detail records carry their header context, but only the record
+        currently yielded is materialized - callers can load in batches
+        without holding the whole file's rows in memory.
+        """
         # Track current header context for detail lines
         current_header = None
         detail_line_number = 0
 
-        with open(data_file, 'r', encoding='latin-1', errors='ignore') as f:
-            for line in f:
+        if os.path.getsize(data_file) == 0:
+            return
+
+        # mmap the file and walk raw line offsets: no text decode and no str
+        # object per line, the kernel page cache backs the buffer directly
+        with open(data_file, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            pos = 0
+            size = len(mm)
+            while pos < size:
+                eol = mm.find(b'\n', pos)
+                if eol < 0:
+                    eol = size
+                line = mm[pos:eol]
+                pos = eol + 1
+
                 record_type = self.identify_record_type(line)
 
                 if record_type == 'INVHDR,X':
                     record = self.parse_line(line, record_type)
                     if record:
-                        results['headers'].append(record)
                         # Update current header context
                         current_header = {
                             'invoice_number': record.get('ivhnum', ''),
@@ -333,6 +388,7 @@ class DibolDataParser:
                             'customer_number': record.get('ivhcus', 0)
                         }
                         detail_line_number = 0  # Reset line counter
+                        yield 'header', record
 
                 elif record_type == 'INVDTL':
                     record = self.parse_line(line, record_type)
@@ -343,12 +399,28 @@ class DibolDataParser:
                         record['invdat'] = current_header['invoice_date']
                         record['invcus'] = current_header['customer_number']
                         record['invlin'] = detail_line_number
-                        results['details'].append(record)
+                        yield 'detail', record
 
                 elif record_type == 'INVPOR,X':
                     record = self.parse_line(line, record_type)
                     if record:
-                        results['po_records'].append(record)
+                        yield 'po', record
+        finally:
+            mm.close()
+
+    def parse_file(self, data_file: str) -> Dict[str, List[Dict]]:
+        """Parse entire data file and return structured data"""
+        results = {
+            'headers': [],
+            'details': [],
+            'po_records': []
+        }
+        buckets = {'header': results['headers'],
+                   'detail': results['details'],
+                   'po': results['po_records']}
+
+        for kind, record in self.iter_records(data_file):
+            buckets[kind].append(record)
 
         return results
 
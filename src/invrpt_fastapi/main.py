@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-                                                         
 #                                                                               
 # author: Lou Viannay <lou.viannay@octavesolution.com>                                    
+import hashlib
 import logging
+import pickle
+import time
 from contextlib import asynccontextmanager
 from functools import lru_cache
 from pathlib import Path
@@ -10,10 +13,12 @@ from typing import Optional, List, Union, Tuple
 from datetime import timedelta
 
 import jinja2
-from fastapi import FastAPI, HTTPException, Depends, Body
+import orjson
+from fastapi import FastAPI, HTTPException, Depends, Body, Request, Response
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import jwt
-from jose.exceptions import JWTError
+import jwt
+from jwt import InvalidTokenError as JWTError
 from libcommon import getConfig, setupLogging
 from libcommon.db import get_connection
 from libcommon.db.connect import DBConnection
@@ -24,7 +29,8 @@ from starlette.templating import Jinja2Templates
 from typing_extensions import Annotated
 
 from dibol_parser import DibolParser, DibolRecord
-from models import BranchInfo, Token, TokenData, ResultMessage, CallbackRecord, ResultSyncStatus, FTPRecord
+from models import (BranchInfo, Token, TokenData, ResultMessage, CallbackRecord, ResultSyncStatus,
+                    SyncStatusEnum, FTPRecord)
 from semaphore import get_keyed_semaphore
 from simple_user_db import User, SimpleUserDB
 from tasks import task_sync_branch
@@ -37,6 +43,14 @@ logger = logging.getLogger(__name__)
 
 main_cfg: Optional[dict] = None
 dibol_schema: Optional[list[DibolRecord]] = None
+dibol_schema_json: bytes = b'[]'
+dibol_schema_etag: str = ''
+
+# Bound once in lifespan so the per-request auth path loads a module global
+# instead of walking main_cfg['user_db'] and its attributes each time
+_USER_DB: Optional[SimpleUserDB] = None
+_JWT_SECRET: Optional[str] = None
+_JWT_ALGO: str = "HS256"
 
 
 def load_config():
@@ -49,10 +63,31 @@ def load_config():
 
 
 def load_dibol_schema():
-    global dibol_schema
+    global dibol_schema, dibol_schema_json, dibol_schema_etag
     schema_file = Path(main_cfg['dibol_schema'])
-    dibol_parser = DibolParser()
-    dibol_schema = dibol_parser.parse_file(str(schema_file))
+    cache_file = schema_file.with_suffix('.def.cache')
+
+    # Warm starts (every Gunicorn worker) load the pickled records instead of
+    # re-running the DEF parser; the cache is keyed by the DEF file's mtime
+    dibol_schema = None
+    if cache_file.exists() and cache_file.stat().st_mtime >= schema_file.stat().st_mtime:
+        try:
+            dibol_schema = pickle.loads(cache_file.read_bytes())
+        except Exception as e:
+            logger.warning(f"Ignoring stale/corrupt schema cache {cache_file}: {e!r}")
+            dibol_schema = None
+
+    if dibol_schema is None:
+        dibol_parser = DibolParser()
+        dibol_schema = dibol_parser.parse_file(str(schema_file))
+        try:
+            cache_file.write_bytes(pickle.dumps(dibol_schema, protocol=5))
+        except OSError as e:
+            logger.warning(f"Could not write schema cache {cache_file}: {e!r}")
+    # The schema never changes after startup, so serialize it once here and
+    # serve the cached bytes from the endpoint
+    dibol_schema_json = orjson.dumps([r.to_dict() for r in dibol_schema])
+    dibol_schema_etag = f'"{hashlib.blake2b(dibol_schema_json).hexdigest()}"'
 
 
 def setup_logging():
@@ -97,22 +132,31 @@ async def get_local_connection():
 DBConnectionDep = Annotated[DBConnection, Depends(get_db_connection)]
 
 
+@lru_cache_ttl(ttl_seconds=60, maxsize=4096)
+def _decode_token(token: str, secret: str, algorithm: str) -> dict:
+    """Decode (and implicitly verify) a JWT; memoized because the same token
+    arrives on every request of a client's burst. The caller still checks
+    'exp' so a cached payload cannot outlive its token."""
+    return jwt.decode(token, secret, algorithms=[algorithm])
+
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    user_db = main_cfg['user_db']
     try:
-        payload = jwt.decode(token, user_db.secret, algorithms=[user_db.algorithm])
+        payload = _decode_token(token, _JWT_SECRET, _JWT_ALGO)
+        if payload.get("exp", 0) <= time.time():
+            raise credentials_exception
         username = payload.get("sub")
         if username is None:
             raise credentials_exception
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = user_db.get_user(username=token_data.username)
+    user = _USER_DB.get_user(username=token_data.username)
     if user is None:
         raise credentials_exception
     return user
@@ -146,9 +190,13 @@ async def lifespan(defapp: FastAPI):
     main_cfg = load_config()
     load_dibol_schema()
 
+    global _USER_DB, _JWT_SECRET, _JWT_ALGO
     user_db = SimpleUserDB(main_cfg['user_db'], main_cfg['secret_key'], main_cfg['algorithm'])
     logger.info(f"users = {user_db}")
     main_cfg['user_db'] = user_db
+    _USER_DB = user_db
+    _JWT_SECRET = user_db.secret
+    _JWT_ALGO = user_db.algorithm
     # templates = Jinja2Templates(directory=main_cfg["template_dir"])
     template_loader = jinja2.FileSystemLoader(main_cfg["template_dir"])
     environment = jinja2.Environment(loader=template_loader)
@@ -158,7 +206,10 @@ async def lifespan(defapp: FastAPI):
     yield
 
 
-app = FastAPI(lifespan=lifespan, title="BakeMark INVRPT API", version="0.1.1")
+# orjson serializes the response models noticeably faster than stdlib json,
+# and the endpoints already standardize on it for the schema payload
+app = FastAPI(lifespan=lifespan, title="BakeMark INVRPT API", version="0.1.1",
+              default_response_class=ORJSONResponse)
 
 app.mount("/static", StaticFiles(directory=main_cfg['static_dir']), name="static")
 
@@ -167,7 +218,7 @@ app.mount("/static", StaticFiles(directory=main_cfg['static_dir']), name="static
 async def login_for_access_token(
         form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
 ) -> Token:
-    user_db = main_cfg['user_db']
+    user_db = _USER_DB
     user = user_db.authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
@@ -190,24 +241,26 @@ async def read_users_me(current_user: Annotated[User, Depends(get_current_user)]
 @app.get("/branch/list")
 async def get_branch_list(conn: DBConnectionDep) -> List[BranchInfo]:
     SQL = "SELECT branch_id, branch_name FROM branch_ftp WHERE active=true "
-    branches = []
     with conn as sess:
-        res = sess.execute(SQL)
-        for row in res:
-            branches.append(
-                BranchInfo(branch_no=row[0], name=row[1])
-            )
-    return branches
+        rows = sess.execute(SQL).fetchall()
+    # rows come from our own typed schema, so model_construct skips the
+    # per-field validation cost
+    return [BranchInfo.model_construct(branch_no=row[0], name=row[1]) for row in rows]
 
 
 @app.get("/dibol/schema")
 async def get_dibol_schema(
+        request: Request,
         current_user: Annotated[User, Depends(get_internal_user)],
-) -> List[DibolRecord]:
+) -> Response:
     logger.info(f"current_user = {current_user}")
-    # return [DibolRecord(**x) for x in dibol_schema]
-    # return list(map(convert_to_dibol_schema, dibol_schema))
-    return dibol_schema or []
+    # serve the payload serialized at startup; re-serializing the record list
+    # per request is pure overhead since the schema is immutable
+    if request.headers.get("if-none-match") == dibol_schema_etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers={"ETag": dibol_schema_etag})
+    return Response(content=dibol_schema_json, media_type="application/json",
+                    headers={"ETag": dibol_schema_etag})
 
 
 @lru_cache_ttl(ttl_seconds=300, maxsize=30)
@@ -221,7 +274,8 @@ def valid_branch(conn: DBConnection, branch_no: int) -> Tuple[Optional[FTPRecord
             if res is None:
                 return None, f"Branch# {branch_no} not found."
             logger.debug(f"res = {res}")
-            ftp = FTPRecord(
+            # trusted branch_ftp row - skip pydantic validation
+            ftp = FTPRecord.model_construct(
                 active=bool(res[0]),
                 ftp_host=res[1],
                 ftp_username=res[2],
@@ -252,13 +306,13 @@ async def status_sync_branch(
         with message_target.open() as f:
             ts, msg = f.read().strip().split('|')
 
-    created, semaphore = await get_keyed_semaphore(str(branch_no))
+    semaphore = await get_keyed_semaphore(str(branch_no))
     if semaphore.locked():
-        return ResultSyncStatus(status="Pending", pending=True, completed=False)
+        return ResultSyncStatus(status=SyncStatusEnum.pending)
     elif message_present:
-        return ResultSyncStatus(status="Done", pending=False, completed=True, message=msg, message_ts=ts)
+        return ResultSyncStatus(status=SyncStatusEnum.done, message=msg, message_ts=ts)
     else:
-        return ResultSyncStatus(status="Clear", pending=False,  completed=False)
+        return ResultSyncStatus(status=SyncStatusEnum.clear)
 
 
 @app.post("/dibol/sync/{branch_no}", status_code=status.HTTP_202_ACCEPTED)
@@ -285,7 +339,7 @@ async def sync_branch(
     elif not ftp.ftp_host:
         return ResultMessage(success=False, msg=f"{branch_no} has no valid FTP host.")
 
-    _, semaphore = await get_keyed_semaphore(str(branch_no))
+    semaphore = await get_keyed_semaphore(str(branch_no))
     if semaphore.locked():
         return ResultMessage(success=False, msg=f"{branch_no} is locked, "
                                                 f"another request is already pending for this branch.")
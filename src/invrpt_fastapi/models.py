@@ -3,10 +3,15 @@
 #                                                                               
 # author: Lou Viannay <lou.viannay@octavesolution.com>
 import datetime
+from enum import Enum
 from typing import List, Union, Annotated, Optional, Literal
 
 from pydantic import BaseModel
-from pydantic import Field, HttpUrl
+from pydantic import Field, HttpUrl, TypeAdapter, computed_field, field_validator
+
+# Built once: each TypeAdapter carries its own pydantic-core schema, so a
+# module-level instance keeps URL validation to a single rust-side call
+_URL_ADAPTER = TypeAdapter(HttpUrl)
 
 
 class Token(BaseModel):
@@ -53,19 +58,36 @@ class ResultMessage(BaseModel):
     msg: str
 
 
+class SyncStatusEnum(str, Enum):
+    pending = "Pending"
+    clear = "Clear"
+    done = "Done"
+
+
 class ResultSyncStatus(BaseModel):
     """Sync Status
     ## Status
     * Pending - There is a background process that is running
     * Clear - No background process was run since startup
     * Done - The background process finished
+
+    `pending`/`completed` are derived from `status` - the enum is the only
+    state, so the flags can never disagree with it.
     """
-    status: Literal["Pending", "Clear", "Done"] = "Clear"
-    pending: bool = False
-    completed: bool = False
+    status: SyncStatusEnum = SyncStatusEnum.clear
     message: str = ""
     message_ts: str = ""
 
+    @computed_field
+    @property
+    def pending(self) -> bool:
+        return self.status is SyncStatusEnum.pending
+
+    @computed_field
+    @property
+    def completed(self) -> bool:
+        return self.status is SyncStatusEnum.done
+
 
 class CallbackRecord(BaseModel):
     """URL to 'callback' after background task is done.
@@ -83,4 +105,11 @@ class CallbackRecord(BaseModel):
 
     """
     method: Optional[Literal["POST", "GET", "PUT"]] = "GET"
-    url: HttpUrl
+    # stored as a plain str: the URL is validated once on the way in, and
+    # internal re-constructions via model_construct skip revalidation
+    url: str
+
+    @field_validator("url", mode="before")
+    @classmethod
+    def _validate_url(cls, value):
+        return str(_URL_ADAPTER.validate_python(value))
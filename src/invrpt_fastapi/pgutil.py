@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-                                                         
 #                                                                               
 # author: Lou Viannay <lou.viannay@octavesolution.com>
+import csv
+import io
 import logging
-from typing import Dict, Any, List, Union
+import threading
+from typing import Dict, Any, List, Tuple, Union
 
 from libcommon.db import get_connection
 from libcommon.db.connect import DBConnection
@@ -13,6 +16,129 @@ from models import FTPRecord
 
 logger = logging.getLogger(__name__)
 
+# Column order shared by the CSV staging buffer and the merge statements
+HEADER_KEYS = (
+    "branch_id", "invoice_number", "invoice_date", "customer_number",
+    "customer_name", "order_number", "invoice_amount", "tax_amount",
+    "salesman_number", "warehouse_number", "transaction_code", "terms_code",
+    "total_cases", "total_pieces", "route",
+)
+DETAIL_KEYS = (
+    "branch_id", "invoice_number", "invoice_date", "customer_number",
+    "line_number", "item_number", "item_description", "quantity",
+    "unit_price", "extended_amount", "vendor_number", "brand", "pack", "unit",
+)
+
+_HEADERS_MERGE = f"""
+    INSERT INTO invoice_headers ({', '.join(HEADER_KEYS)})
+    SELECT {', '.join(HEADER_KEYS)} FROM invoice_headers_stage
+    ON CONFLICT (branch_id, invoice_number, invoice_date, customer_number)
+    DO UPDATE SET
+        customer_name = EXCLUDED.customer_name,
+        order_number = EXCLUDED.order_number,
+        invoice_amount = EXCLUDED.invoice_amount,
+        tax_amount = EXCLUDED.tax_amount,
+        salesman_number = EXCLUDED.salesman_number,
+        warehouse_number = EXCLUDED.warehouse_number,
+        transaction_code = EXCLUDED.transaction_code,
+        terms_code = EXCLUDED.terms_code,
+        total_cases = EXCLUDED.total_cases,
+        total_pieces = EXCLUDED.total_pieces,
+        route = EXCLUDED.route,
+        updated_at = CURRENT_TIMESTAMP;
+"""
+
+# Constructed once: SQLAlchemy caches the compiled form per statement object,
+# so reusing these TextClauses across calls avoids re-parse/re-plan work on
+# the executemany fallback path
+_HEADERS_UPSERT = text("""
+    INSERT INTO invoice_headers (
+        branch_id, invoice_number, invoice_date, customer_number,
+        customer_name, order_number, invoice_amount, tax_amount,
+        salesman_number, warehouse_number, transaction_code, terms_code,
+        total_cases, total_pieces, route
+    ) VALUES (
+        :branch_id, :invoice_number, :invoice_date, :customer_number,
+        :customer_name, :order_number, :invoice_amount, :tax_amount,
+        :salesman_number, :warehouse_number, :transaction_code, :terms_code,
+        :total_cases, :total_pieces, :route
+    )
+    ON CONFLICT (branch_id, invoice_number, invoice_date, customer_number)
+    DO UPDATE SET
+        customer_name = EXCLUDED.customer_name,
+        order_number = EXCLUDED.order_number,
+        invoice_amount = EXCLUDED.invoice_amount,
+        tax_amount = EXCLUDED.tax_amount,
+        salesman_number = EXCLUDED.salesman_number,
+        warehouse_number = EXCLUDED.warehouse_number,
+        transaction_code = EXCLUDED.transaction_code,
+        terms_code = EXCLUDED.terms_code,
+        total_cases = EXCLUDED.total_cases,
+        total_pieces = EXCLUDED.total_pieces,
+        route = EXCLUDED.route,
+        updated_at = CURRENT_TIMESTAMP;
+""")
+
+_DETAILS_UPSERT = text("""
+    INSERT INTO invoice_details (
+        branch_id, invoice_number, invoice_date, customer_number,
+        line_number, item_number, item_description, quantity,
+        unit_price, extended_amount, vendor_number, brand, pack, unit
+    ) VALUES (
+        :branch_id, :invoice_number, :invoice_date, :customer_number,
+        :line_number, :item_number, :item_description, :quantity,
+        :unit_price, :extended_amount, :vendor_number, :brand, :pack, :unit
+    )
+    ON CONFLICT (branch_id, invoice_number, invoice_date, customer_number, line_number)
+    DO UPDATE SET
+        item_number = EXCLUDED.item_number,
+        item_description = EXCLUDED.item_description,
+        quantity = EXCLUDED.quantity,
+        unit_price = EXCLUDED.unit_price,
+        extended_amount = EXCLUDED.extended_amount,
+        vendor_number = EXCLUDED.vendor_number,
+        brand = EXCLUDED.brand,
+        pack = EXCLUDED.pack,
+        unit = EXCLUDED.unit,
+        updated_at = CURRENT_TIMESTAMP;
+""")
+
+_TOUCH_BRANCH = text("""
+    UPDATE
+        branch_ftp
+    SET
+        last_processed = CURRENT_TIMESTAMP,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE
+        branch_id = :branch_number;
+""")
+
+_FETCH_BRANCH = text("""
+    SELECT
+        ftp_host, ftp_username, ftp_password, remote_filename
+    FROM
+        branch_ftp
+    WHERE
+        branch_id = :branch_id
+""")
+
+_DETAILS_MERGE = f"""
+    INSERT INTO invoice_details ({', '.join(DETAIL_KEYS)})
+    SELECT {', '.join(DETAIL_KEYS)} FROM invoice_details_stage
+    ON CONFLICT (branch_id, invoice_number, invoice_date, customer_number, line_number)
+    DO UPDATE SET
+        item_number = EXCLUDED.item_number,
+        item_description = EXCLUDED.item_description,
+        quantity = EXCLUDED.quantity,
+        unit_price = EXCLUDED.unit_price,
+        extended_amount = EXCLUDED.extended_amount,
+        vendor_number = EXCLUDED.vendor_number,
+        brand = EXCLUDED.brand,
+        pack = EXCLUDED.pack,
+        unit = EXCLUDED.unit,
+        updated_at = CURRENT_TIMESTAMP;
+"""
+
 
 class PostgreSQLInvoiceLoader:
     """Load invoice data into PostgreSQL"""
@@ -30,32 +156,15 @@ class PostgreSQLInvoiceLoader:
 
     def update_last_processed(self, branch_number: Union[str, int]):
         """Update last_processed timestamp for a branch"""
-
-        sql = """
-            UPDATE 
-                branch_ftp 
-            SET 
-                last_processed = CURRENT_TIMESTAMP,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE 
-                branch_id = :branch_number;
-        """
         logger.info(f"Updating branch_ftp 'updated_at' to <CURRENT_TIMESTAMP> - {self.connection}")
         with self.connection as sess:
-            sess.execute(sql, params={'branch_number': int(branch_number)})
+            sess.execute(_TOUCH_BRANCH, params={'branch_number': int(branch_number)})
 
     def fetch_branch_data(self, branch_id: Union[str, int]) -> FTPRecord:
-        sql = """
-        SELECT 
-            ftp_host, ftp_username, ftp_password, remote_filename 
-        FROM 
-            branch_ftp
-        WHERE
-            branch_id = :branch_id
-        """
         with self.connection as sess:
-            row = sess.execute(sql, params={'branch_id': branch_id}).fetchone()
-            data = FTPRecord(
+            row = sess.execute(_FETCH_BRANCH, params={'branch_id': branch_id}).fetchone()
+            # trusted branch_ftp row - skip pydantic validation
+            data = FTPRecord.model_construct(
                 ftp_host=row[0],
                 ftp_username=row[1],
                 ftp_password=row[2],
@@ -63,115 +172,111 @@ class PostgreSQLInvoiceLoader:
             )
         return data
 
+    def _bulk_upsert(self, rows: List[tuple], keys: Tuple[str, ...], table: str,
+                     merge_sql: str, fallback_sql):
+        """Stage rows with COPY FROM STDIN and merge in one statement.
+
+        One COPY plus one INSERT..SELECT replaces a parameterized insert per
+        row. Falls back to the executemany upsert when the raw psycopg2
+        connection is not reachable through the session.
+        """
+        with self.connection as sess:
+            try:
+                raw = sess.connection().connection
+            except AttributeError:
+                logger.debug("Raw DBAPI connection unavailable, using executemany upsert")
+                sess.execute(fallback_sql, [dict(zip(keys, row)) for row in rows])
+                return
+
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerows(rows)
+            buf.seek(0)
+
+            cur = raw.cursor()
+            try:
+                cur.execute(f"CREATE TEMP TABLE {table}_stage (LIKE {table} INCLUDING DEFAULTS)")
+                cur.copy_expert(
+                    f"COPY {table}_stage ({', '.join(keys)}) FROM STDIN WITH (FORMAT CSV)", buf)
+                cur.execute(merge_sql)
+                cur.execute(f"DROP TABLE {table}_stage")
+            finally:
+                cur.close()
+
     def load_headers(self, headers: List[Dict], branch_id: Union[str, int]) -> int:
         """Load invoice headers with upsert"""
         if not headers:
             return 0
 
-        insert_sql = """
-            INSERT INTO invoice_headers (
-                branch_id, invoice_number, invoice_date, customer_number,
-                customer_name, order_number, invoice_amount, tax_amount,
-                salesman_number, warehouse_number, transaction_code, terms_code,
-                total_cases, total_pieces, route
-            ) VALUES (
-                :branch_id, :invoice_number, :invoice_date, :customer_number, 
-                :customer_name, :order_number, :invoice_amount, :tax_amount, 
-                :salesman_number, :warehouse_number, :transaction_code, :terms_code, 
-                :total_cases, :total_pieces, :route
-            )
-            ON CONFLICT (branch_id, invoice_number, invoice_date, customer_number)
-            DO UPDATE SET
-                customer_name = EXCLUDED.customer_name,
-                order_number = EXCLUDED.order_number,
-                invoice_amount = EXCLUDED.invoice_amount,
-                tax_amount = EXCLUDED.tax_amount,
-                salesman_number = EXCLUDED.salesman_number,
-                warehouse_number = EXCLUDED.warehouse_number,
-                transaction_code = EXCLUDED.transaction_code,
-                terms_code = EXCLUDED.terms_code,
-                total_cases = EXCLUDED.total_cases,
-                total_pieces = EXCLUDED.total_pieces,
-                route = EXCLUDED.route,
-                updated_at = CURRENT_TIMESTAMP;
-        """
-
+        # positional tuples in HEADER_KEYS order: no 15-key dict per row
         rows = []
         for h in headers:
-            rows.append({
-                "branch_id": branch_id, 
-                "invoice_number": h.get('ivhnum', ''),  # IVHNUM = Invoice Number (pos 2-7)
-                "invoice_date": h.get('ivhdat', ''),  # IVHDAT = Invoice Date (pos 211-218)
-                "customer_number": h.get('ivhcus', 0),  # IVHCUS = Customer Number (pos 23-27)
-                "customer_name": h.get('ivhcnm', ''),  # IVHCNM = Customer Name (pos 35-59)
-                "order_number": h.get('ivhord', 0),  # IVHORD = Order Number (pos 9-14)
-                "invoice_amount": h.get('ivhdue', 0),  # IVHDUE = Invoice Amount (pos 140-147)
-                "tax_amount": h.get('ivhtax', 0),  # IVHTAX = Tax Amount (pos 102-108)
-                "salesman_number": h.get('ivhslm', 0),  # IVHSLM = Salesman Number (pos 21-22)
-                "warehouse_number": h.get('ivhwhe', 0),  # IVHWHE = Warehouse Number (pos 160-161)
-                "transaction_code": h.get('ivhtrc', 0),  # IVHTRC = Transaction Code (pos 60-60)
-                "terms_code": h.get('ivhtrm', 0),  # IVHTRM = Terms Code (pos 85-86)
-                "total_cases": h.get('ivhtcs', 0),  # IVHTCS = Total Cases (pos 88-91)
-                "total_pieces": h.get('ivhtpc', 0),  # IVHTPC = Total Pieces (pos 92-95)
-                "route": h.get('ivhrut', 0)  # IVHRUT = Route (pos 148-153)
-            })
-        sql = text(insert_sql)
+            rows.append((
+                branch_id,
+                h.get('ivhnum', ''),  # IVHNUM = Invoice Number (pos 2-7)
+                h.get('ivhdat', ''),  # IVHDAT = Invoice Date (pos 211-218)
+                h.get('ivhcus', 0),  # IVHCUS = Customer Number (pos 23-27)
+                h.get('ivhcnm', ''),  # IVHCNM = Customer Name (pos 35-59)
+                h.get('ivhord', 0),  # IVHORD = Order Number (pos 9-14)
+                h.get('ivhdue', 0),  # IVHDUE = Invoice Amount (pos 140-147)
+                h.get('ivhtax', 0),  # IVHTAX = Tax Amount (pos 102-108)
+                h.get('ivhslm', 0),  # IVHSLM = Salesman Number (pos 21-22)
+                h.get('ivhwhe', 0),  # IVHWHE = Warehouse Number (pos 160-161)
+                h.get('ivhtrc', 0),  # IVHTRC = Transaction Code (pos 60-60)
+                h.get('ivhtrm', 0),  # IVHTRM = Terms Code (pos 85-86)
+                h.get('ivhtcs', 0),  # IVHTCS = Total Cases (pos 88-91)
+                h.get('ivhtpc', 0),  # IVHTPC = Total Pieces (pos 92-95)
+                h.get('ivhrut', 0)  # IVHRUT = Route (pos 148-153)
+            ))
         logger.info("Saving header data to DB")
-        with self.connection as sess:
-            sess.execute(sql, rows)
+        self._bulk_upsert(rows, HEADER_KEYS, "invoice_headers", _HEADERS_MERGE, _HEADERS_UPSERT)
 
     def load_details(self, details: List[Dict], branch_id: Union[str, int]) -> int:
         """Load invoice details with upsert"""
         if not details:
             return 0
 
-        insert_sql = """
-            INSERT INTO invoice_details (
-                branch_id, invoice_number, invoice_date, customer_number,
-                line_number, item_number, item_description, quantity,
-                unit_price, extended_amount, vendor_number, brand, pack, unit
-            ) VALUES (
-                :branch_id, :invoice_number, :invoice_date, :customer_number, 
-                :line_number, :item_number, :item_description, :quantity, 
-                :unit_price, :extended_amount, :vendor_number, :brand, :pack, :unit
-            )
-            ON CONFLICT (branch_id, invoice_number, invoice_date, customer_number, line_number)
-            DO UPDATE SET
-                item_number = EXCLUDED.item_number,
-                item_description = EXCLUDED.item_description,
-                quantity = EXCLUDED.quantity,
-                unit_price = EXCLUDED.unit_price,
-                extended_amount = EXCLUDED.extended_amount,
-                vendor_number = EXCLUDED.vendor_number,
-                brand = EXCLUDED.brand,
-                pack = EXCLUDED.pack,
-                unit = EXCLUDED.unit,
-                updated_at = CURRENT_TIMESTAMP;
-        """
-
+        # positional tuples in DETAIL_KEYS order: no 14-key dict per row
         rows = []
         for d in details:
-            rows.append({
-                "branch_id": branch_id,
-                "invoice_number": d.get('invnum', ''),  # INVNUM = Invoice Number (pos 2-7)
-                "invoice_date": d.get('invdat', ''),  # INVDAT = Invoice Date (need to check position)
-                "customer_number": d.get('invcus', 0),  # INVCUS = Customer Number (need to check)
-                "line_number": d.get('invlin', 0),  # INVLIN = Line Number (need to check)
-                "item_number": d.get('invitm', 0),  # INVITM = Item Number (pos 9-13)
-                "item_description": d.get('invdsc', ''),  # INVDSC = Description (pos 60-84)
-                "quantity": d.get('invqty', 0),  # INVQTY = Quantity (pos 38-43)
-                "unit_price": d.get('invsel', 0),  # INVSEL = Sell Price/Unit Price (pos 104-109)
-                "extended_amount": d.get('invlam', 0),  # INVLAM = Extended Amount (pos 136-142)
-                "vendor_number": d.get('invven', 0),  # INVVEN = Vendor Number (pos 131-134)
-                "brand": d.get('invbrn', ''),  # INVBRN = Brand (pos 24-29)
-                "pack": d.get('invpak', ''),  # INVPAK = Pack (pos 30-37)
-                "unit": d.get('invunt', '')  # INVUNT = Unit (pos 21-23)
-            })
-
-        sql = text(insert_sql)
+            rows.append((
+                branch_id,
+                d.get('invnum', ''),  # INVNUM = Invoice Number (pos 2-7)
+                d.get('invdat', ''),  # INVDAT = Invoice Date (need to check position)
+                d.get('invcus', 0),  # INVCUS = Customer Number (need to check)
+                d.get('invlin', 0),  # INVLIN = Line Number (need to check)
+                d.get('invitm', 0),  # INVITM = Item Number (pos 9-13)
+                d.get('invdsc', ''),  # INVDSC = Description (pos 60-84)
+                d.get('invqty', 0),  # INVQTY = Quantity (pos 38-43)
+                d.get('invsel', 0),  # INVSEL = Sell Price/Unit Price (pos 104-109)
+                d.get('invlam', 0),  # INVLAM = Extended Amount (pos 136-142)
+                d.get('invven', 0),  # INVVEN = Vendor Number (pos 131-134)
+                d.get('invbrn', ''),  # INVBRN = Brand (pos 24-29)
+                d.get('invpak', ''),  # INVPAK = Pack (pos 30-37)
+                d.get('invunt', '')  # INVUNT = Unit (pos 21-23)
+            ))
+
         logger.info("Saving detail data to DB")
-        with self.connection as sess:
-            sess.execute(sql, rows)
+        self._bulk_upsert(rows, DETAIL_KEYS, "invoice_details", _DETAILS_MERGE, _DETAILS_UPSERT)
+
+
+# Loaders cached per (config, thread): the asyncio.to_thread worker threads
+# are reused, so each one keeps its connection alive across branch syncs
+# instead of paying connect/auth/TLS per task. One connection per thread also
+# keeps psycopg2's thread-safety rules intact.
+_loader_cache: Dict[Tuple[int, int], PostgreSQLInvoiceLoader] = {}
+_loader_lock = threading.Lock()
+
+
+def get_invoice_loader(db_cfg: dict) -> PostgreSQLInvoiceLoader:
+    """Return the calling thread's shared loader for this database config."""
+    key = (id(db_cfg), threading.get_ident())
+    with _loader_lock:
+        loader = _loader_cache.get(key)
+        if loader is None:
+            loader = PostgreSQLInvoiceLoader(db_cfg)
+            _loader_cache[key] = loader
+    return loader
 
 
 def main():
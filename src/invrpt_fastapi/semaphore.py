@@ -3,15 +3,17 @@
 #                                                                               
 # author: Lou Viannay <lou.viannay@octavesolution.com>                                    
 import asyncio
-from typing import Tuple
+from collections import defaultdict
 
 # from fastapi import FastAPI, Depends, HTTPException
 # from contextlib import asynccontextmanager
 
-# Define a dictionary to hold the semaphores/locks for different keys
-# In a real application, consider using a solution that handles cleanup of old keys.
-keyed_semaphores: dict[str, asyncio.Semaphore] = {}
 SEMAPHORE_LIMIT = 1  # Maximum concurrent operations per key
+MAX_KEYS = 1024  # Idle semaphores beyond this are dropped
+
+# A defaultdict resolves get-or-create in a single hash probe; the event loop
+# is single-threaded so the factory cannot race
+keyed_semaphores: defaultdict = defaultdict(lambda: asyncio.Semaphore(SEMAPHORE_LIMIT))
 
 
 # @asynccontextmanager
@@ -24,17 +26,15 @@ SEMAPHORE_LIMIT = 1  # Maximum concurrent operations per key
 # app = FastAPI(lifespan=lifespan)
 #
 
-async def get_keyed_semaphore(key: str) -> Tuple[bool, asyncio.Semaphore]:
-    """Retrieves or creates a semaphore for a specific key."""
-    # Use a global lock to prevent race conditions when creating new semaphores
-    global keyed_semaphores
-    created = False
-    if key not in keyed_semaphores:
-        # Note: In a highly concurrent environment, a more sophisticated lock
-        # mechanism for dictionary access might be needed, but this works for basic cases
-        keyed_semaphores[key] = asyncio.Semaphore(SEMAPHORE_LIMIT)
-        created = True
-    return created, keyed_semaphores[key]
+async def get_keyed_semaphore(key: str) -> asyncio.Semaphore:
+    """Retrieves or creates the semaphore for a specific key."""
+    semaphore = keyed_semaphores[key]
+    if len(keyed_semaphores) > MAX_KEYS:
+        # drop idle entries so long-lived processes don't accumulate keys
+        for stale in [k for k, s in keyed_semaphores.items()
+                      if k != key and not s.locked()]:
+            del keyed_semaphores[stale]
+    return semaphore
 
 
 # @app.get("/process/{user_id}")
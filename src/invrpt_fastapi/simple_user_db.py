@@ -7,7 +7,7 @@ from datetime import datetime, timezone, timedelta
 from pathlib import Path
 from typing import Optional
 
-from jose import jwt
+import jwt
 from libcommon.misc.config import yml_loader
 from pwdlib import PasswordHash
 from pydantic import BaseModel
@@ -43,8 +43,6 @@ def fake_hash_password(password: str) -> str:
 
 
 def verify_password(plain_password, hashed_password):
-    plain_hashed_password = password_hash.hash(plain_password)
-    logger.debug(f"plain_password_hashed = {plain_hashed_password}")
     return password_hash.verify(plain_password, hashed_password)
 
 
@@ -62,16 +60,26 @@ class SimpleUserDB(object):
         self.__db = load_db(user_db_path)
         self.secret = secret
         self.algorithm = algorithm
+        # encode the HMAC key once instead of per token
+        self._key = secret.encode() if isinstance(secret, str) else secret
+        # the yml is immutable for the process lifetime, so each username
+        # only needs to be validated into a UserInDB model once
+        self.__user_cache: dict = {}
 
     def fake_decode_token(self, token):
         user = self.get_user(token)
         return user
 
     def get_user(self, username: str) -> Optional[User]:
+        user = self.__user_cache.get(username)
+        if user is not None:
+            return user
         if username in self.__db:
             user_dict = self.__db[username]
             logger.debug(f"user_dict = ({type(user_dict)}) {user_dict}")
-            return UserInDB(**user_dict)
+            user = UserInDB(**user_dict)
+            self.__user_cache[username] = user
+            return user
 
     def authenticate_user(self, username: str, password: str):
         user = self.get_user(username)
@@ -90,7 +98,7 @@ class SimpleUserDB(object):
         else:
             expire = datetime.now(timezone.utc) + timedelta(minutes=15)
         to_encode.update({"exp": expire})
-        encoded_jwt = jwt.encode(to_encode, self.secret, algorithm=self.algorithm)
+        encoded_jwt = jwt.encode(to_encode, self._key, algorithm=self.algorithm)
         return encoded_jwt
 
     def __str__(self):
@@ -2,15 +2,18 @@
 # -*- coding: utf-8 -*-                                                         
 #                                                                               
 # author: Lou Viannay <lou.viannay@octavesolution.com>                                    
+import asyncio
+import heapq
 import logging
 import os
+import threading
 import time
-from datetime import datetime
-from functools import lru_cache, wraps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from math import log
 from pathlib import Path
-from typing import Union, Optional, Tuple
-
-import pytz
+from typing import Dict, List, Union, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -19,12 +22,18 @@ def get_file_count(folder: Union[Path, str]) -> int:
     return sum(1 for entry in os.scandir(folder) if entry.is_file())
 
 
-def find_oldest_file(directory_path: Union[Path, str]) -> Optional[Tuple[int, Path]]:
+def find_oldest_file(directory_path: Union[Path, str],
+                     assume_files_only: bool = True) -> Optional[Tuple[int, Path]]:
     """
     Finds the oldest file (based on creation time) in a given directory.
 
     Args:
         directory_path: The path to the directory to search.
+        assume_files_only: Treat every entry as a regular file. The archive
+            dirs this scans are maintained solely by this module and hold
+            nothing else, so the per-entry is_file() check - a forced stat
+            on filesystems without d_type - can be skipped. Pass False for
+            directories that may contain subfolders or symlinks.
 
     Returns:
         None if no files are found or a Tuple[int, Path] otherwise.
@@ -37,78 +46,247 @@ def find_oldest_file(directory_path: Union[Path, str]) -> Optional[Tuple[int, Pa
         logger.error(f"Error: '{directory_path}' is not a valid directory.")
         return None
 
-    oldest_file = None
-    oldest_time = float('inf')  # Initialize with a very large time
+    # Phase 1 gathers (st_ctime_ns, path) pairs - one stat per entry, with
+    # DirEntry caching the type from the directory read - and phase 2 is a
+    # single builtin min() reduction over int-keyed tuples, so the compare
+    # loop runs in C rather than per-entry Python branches.
+    candidates = []
     count = 0
-    for file_path in target_directory.iterdir():
-        if file_path.is_file():
+    with os.scandir(target_directory) as entries:
+        for entry in entries:
+            if not assume_files_only and not entry.is_file(follow_symlinks=False):
+                continue
             count += 1
             try:
-                creation_time = file_path.stat().st_ctime
-                if creation_time == oldest_time:
-                    if file_path < oldest_file:  # compare their file names to check which is 'smaller'
-                        oldest_file = file_path
-                        oldest_time = creation_time
-                elif creation_time < oldest_time:
-                    oldest_time = creation_time
-                    oldest_file = file_path
+                candidates.append((entry.stat(follow_symlinks=False).st_ctime_ns, entry.path))
             except OSError as e:
-                logger.error(f"Could not get stats for {file_path}: {e}", exc_info=True)
-                continue
-    return count, oldest_file
+                logger.error(f"Could not get stats for {entry.path}: {e}", exc_info=True)
+
+    if not candidates:
+        return count, None
+    return count, Path(min(candidates)[1])
 
 
 def archive_name(fpath: Path) -> str:
-    suffixes = fpath.suffixes
-    stem = fpath.stem.strip().split('_')[0]
-    timestamp = datetime.now(tz=pytz.UTC).strftime('%Y%m%d_%H%M%S_%f')
-    return f'{stem}_{timestamp}' + ''.join(suffixes)
+    # one pass over the raw name instead of the suffixes/stem PurePath
+    # properties, which each re-walk the filename
+    name = fpath.name
+    dot = name.find('.')
+    stem, suffixes = (name, '') if dot < 0 else (name[:dot], name[dot:])
+    stem = stem.split('_', 1)[0].strip()
+    # the suffix only needs to be a unique UTC stamp - integer formatting of
+    # time_ns skips the tz-aware datetime construction and strftime's format
+    # parsing on every archive
+    s, ns_rem = divmod(time.time_ns(), 1_000_000_000)
+    t = time.gmtime(s)
+    timestamp = (f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}"
+                 f"_{t.tm_hour:02d}{t.tm_min:02d}{t.tm_sec:02d}_{ns_rem // 1000:06d}")
+    return f'{stem}_{timestamp}{suffixes}'
+
+
+# One min-heap of (ctime_ns, name) per archive directory: once warmed, an
+# archive insertion is a heappush/heappop instead of a directory rescan.
+# Nanosecond ints compare faster than ctime floats and never tie.
+_archive_heaps: Dict[str, List[Tuple[int, str]]] = {}
+_archive_heaps_lock = threading.Lock()
+
+# Directories below this size are stat'ed inline; beyond it the per-entry
+# syscall latency dominates and the stats are fanned out across threads
+# (stat releases the GIL, so the workers genuinely overlap)
+_PARALLEL_STAT_THRESHOLD = 4096
+
+
+def _stat_chunk(dirfd: int, names: List[str]) -> List[Tuple[int, str]]:
+    """Stat a batch of names relative to an open directory fd"""
+    out = []
+    for name in names:
+        try:
+            out.append((os.stat(name, dir_fd=dirfd, follow_symlinks=False).st_ctime_ns, name))
+        except OSError as e:
+            logger.error(f"Could not get stats for {name}: {e}", exc_info=True)
+    return out
+
+
+def _scan_archive_heap(dirfd: int) -> List[Tuple[int, str]]:
+    """Build the (ctime, name) heap for a directory in one scandir pass
+
+    All stats are dir_fd-relative, so the kernel resolves each name against
+    the already-open directory instead of walking the full path per file.
+    """
+    with os.scandir(dirfd) as entries:
+        names = [entry.name for entry in entries
+                 if entry.is_file(follow_symlinks=False)]
 
+    if len(names) <= _PARALLEL_STAT_THRESHOLD:
+        heap = _stat_chunk(dirfd, names)
+    else:
+        # large directory: fan the stats out across threads in even chunks
+        workers = min(8, os.cpu_count() or 1)
+        chunk = -(-len(names) // workers)
+        heap = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_stat_chunk, dirfd, names[i:i + chunk])
+                       for i in range(0, len(names), chunk)]
+            for future in futures:
+                heap.extend(future.result())
 
-def cleanup_old_archives(archive_dir: Path, keep_files: Optional[int] = None):
+    heapq.heapify(heap)
+    return heap
+
+
+def cleanup_old_archives(archive_dir: Path, keep_files: Optional[int] = None,
+                         new_file: Optional[Path] = None):
     """
     Remove oldest archive files if count exceeds keep_files limit
 
     Args:
         archive_dir: Directory containing archived files for a branch
         keep_files: Number of files to keep
+        new_file: The file just added to the archive. When given and the
+            directory's heap is already warm, eviction is O(log K) with no
+            rescan; without it the heap is rebuilt from one scandir pass.
     """
     if keep_files is None or keep_files <= 0:
         return  # No limit, keep all files
 
-    count, oldest = find_oldest_file(archive_dir)
+    key = os.fspath(archive_dir)
+    try:
+        # one open buys dir_fd-relative stat and unlink for the whole call
+        dirfd = os.open(key, os.O_DIRECTORY | os.O_CLOEXEC)
+    except OSError as e:
+        logger.error(f"Could not open archive dir {key}: {e!r}", exc_info=e)
+        return
 
-    # Normally, this loop iterates only once, as it is called every time a new file is added
-    while count > keep_files:
-        try:
-            oldest.unlink()
-            logger.info(f"Removed old archive: {oldest.name}")
-        except OSError as e:
-            logger.error(f"Cleanup failed due to error while removing file {oldest}: {e!r}", exc_info=e)
-            break
+    try:
+        with _archive_heaps_lock:
+            heap = _archive_heaps.get(key)
+            if heap is None or new_file is None:
+                # no record of what changed on disk - rebuild from a single scan
+                heap = _scan_archive_heap(dirfd)
+                _archive_heaps[key] = heap
+            else:
+                try:
+                    heapq.heappush(heap, (new_file.stat().st_ctime_ns, new_file.name))
+                except OSError as e:
+                    logger.error(f"Could not get stats for {new_file}: {e}", exc_info=True)
 
-        count, oldest = find_oldest_file(archive_dir)
+            while len(heap) > keep_files:
+                _, name = heapq.heappop(heap)
+                try:
+                    os.unlink(name, dir_fd=dirfd)
+                    logger.info(f"Removed old archive: {name}")
+                except OSError as e:
+                    logger.error(f"Cleanup failed due to error while removing file {name}: {e!r}", exc_info=e)
+                    break
+    finally:
+        os.close(dirfd)
+
+
+def _evict_scored(cache: OrderedDict, window: int, now: int):
+    """Drop the worst entry from the coldest `window` cache slots.
+
+    Among the least recently used entries, removes the one scoring lowest
+    on log(hits + ttl remaining): a stale-but-hot entry can outlive a
+    fresher one that was never hit again.
+    """
+    worst_key = None
+    worst_score = None
+    for i, (k, entry) in enumerate(cache.items()):
+        if i >= window:
+            break
+        remaining = max(0, entry[1] - now) / 1_000_000_000
+        score = log(entry[2] + remaining + 1e-9)
+        if worst_score is None or score < worst_score:
+            worst_key = k
+            worst_score = score
+    del cache[worst_key]
 
 
 def lru_cache_ttl(ttl_seconds, maxsize=None):
+    """LRU cache decorator whose entries expire ttl_seconds after insertion.
+
+    Entries carry their own expiry, so one key timing out no longer flushes
+    every other key the way the old time-salted lru_cache did, and a hit is
+    a single dict probe instead of a division plus a salted lookup.
+    """
+    ttl_ns = int(ttl_seconds * 1_000_000_000)
+
     def decorator(func):
-        @lru_cache(maxsize=maxsize)  # Use lru_cache for capacity management
-        def wrapper(*args, __time_salt, **kwargs):
-            return func(*args, **kwargs)
+        cache = OrderedDict()  # key -> [result, expiry_ns, hits]
+        lock = threading.Lock()
+        # bound once: the hit path loads a closure cell instead of doing the
+        # time-module attribute walk per call (monotonic_ns is vDSO-backed)
+        _mono = time.monotonic_ns
+        # eviction candidates come from the coldest tenth of the cache
+        window = max(1, maxsize // 10) if maxsize else 1
 
         @wraps(func)
         def wrapped(*args, **kwargs):
-            # Calculate time_salt based on current time and TTL
-            time_salt = int(time.time() / ttl_seconds)
-            return wrapper(*args, __time_salt=time_salt, **kwargs)
+            # positional-only calls (the norm here) key straight off args,
+            # skipping the sort and tuple build for an empty kwargs
+            key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+            # monotonic_ns is immune to wall-clock jumps
+            now = _mono()
+            with lock:
+                entry = cache.get(key)
+                if entry is not None and now < entry[1]:
+                    entry[2] += 1
+                    cache.move_to_end(key)
+                    return entry[0]
+
+            result = func(*args, **kwargs)
+            with lock:
+                cache[key] = [result, now + ttl_ns, 0]
+                cache.move_to_end(key)
+                if maxsize is not None and len(cache) > maxsize:
+                    _evict_scored(cache, window, now)
+            return result
+        return wrapped
+    return decorator
+
+
+def async_lru_cache_ttl(ttl_seconds, maxsize=None):
+    """lru_cache_ttl for coroutine functions.
+
+    The cache bookkeeping is the same synchronous dict work - it never
+    blocks, so plain locking is fine on the event loop - but misses await
+    the wrapped coroutine instead of calling into it, keeping slow bodies
+    from stalling other requests on the loop thread.
+    """
+    ttl_ns = int(ttl_seconds * 1_000_000_000)
+
+    def decorator(func):
+        cache = OrderedDict()  # key -> [result, expiry_ns, hits]
+        lock = threading.Lock()
+        _mono = time.monotonic_ns
+        window = max(1, maxsize // 10) if maxsize else 1
+
+        @wraps(func)
+        async def wrapped(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+            now = _mono()
+            with lock:
+                entry = cache.get(key)
+                if entry is not None and now < entry[1]:
+                    entry[2] += 1
+                    cache.move_to_end(key)
+                    return entry[0]
+
+            result = await func(*args, **kwargs)
+            with lock:
+                cache[key] = [result, now + ttl_ns, 0]
+                cache.move_to_end(key)
+                if maxsize is not None and len(cache) > maxsize:
+                    _evict_scored(cache, window, now)
+            return result
         return wrapped
     return decorator
 
 
-@lru_cache_ttl(5, 32)
-def test_func(value: int):
+@async_lru_cache_ttl(5, 32)
+async def test_func(value: int):
     logger.debug("test_func executed.")
-    time.sleep(1)
+    await asyncio.sleep(1)
     return value * 2
 
 